@@ -1,6 +1,6 @@
 import gradio as gr
 import os
-from PIL import Image, ImageDraw
+import numpy as np
 
 # Default image path
 print(os.path.dirname(__file__))
@@ -8,14 +8,14 @@ image_path = os.path.join(os.path.dirname(__file__), 'img_18.jpg')
 
 # Gradio function to detect faces
 def rotate_image(image):
-    return image.rotate(90)
+    return np.rot90(image)
 
 # Define the Gradio app
 iface = gr.Interface(
     fn=rotate_image,
-    inputs = gr.Image(type="pil", value=
+    inputs = gr.Image(type="numpy", value=
                       image_path),
-    outputs="image",
+    outputs=gr.Image(type="numpy"),
     live=False,
 )
 
@@ -1,66 +1,97 @@
 import numpy as np
 import logging
-import glob
 import os
-import numpy as np
 import boto3
-from sklearn.model_selection import train_test_split
+from botocore.config import Config
+import zlib
+from collections import Counter
 from dynamo import DynamoDBTable
 from credentials import AWS_ACCESS_KEY, AWS_SECRET_ACCESS_KEY, AWS_REGION
 
 def split_list_on_element(input_list, split_element='/'):
     """
-    Split a list on a specified element and return a list of sublists.
+    Split a list on a specified element and yield the resulting sublists.
+
+    The split points are found with a single vectorized numpy.char.find over
+    all items, and the input list is then sliced between them.
     
     :param input_list: The list to be split.
     :param split_element: The element at which to split the list. Default is '/'.
-    :return: A list of sublists after splitting the input list on the specified element.
+    :return: A generator of sublists after splitting the input list on the specified element.
+    """
+    if len(input_list) == 0:
+        return
+    is_split = np.char.find(np.asarray(input_list, dtype=str), split_element) > 0
+    starts = np.flatnonzero(is_split)
+    bounds = [0] + [int(i) for i in starts if i > 0] + [len(input_list)]
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        yield input_list[start:end]
+
+def read_lines(file_path):
+    """
+    Read a text file and return its lines with surrounding whitespace removed.
+
+    :param file_path: The path of the file to read.
+    :return: A list of stripped lines.
     """
-    result = []
-    sublist = []
-    for item in input_list:
-        if item.find(split_element) > 0:
-            if sublist:
-                result.append(sublist)
-                sublist = [item]
-            else:
-                sublist.append(item)
-        else:
-            sublist.append(item)
-    if sublist:
-        result.append(sublist)
-    return result
-
-def map_list_to_json(x):
+    with open(file_path, 'r') as f:
+        return [line.strip() for line in f]
+
+def map_list_to_json(x, test_percent=20):
     """
     Maps a list to a JSON object.
 
+    The entry is assigned to the test set when the CRC32 of its image path
+    falls in the first test_percent of buckets, so the split is the same on
+    every run without shuffling the whole dataset.
+
     Args:
         x: The input list containing image_name, num_faces, and faces.
+        test_percent: The percentage of entries put in the test set.
 
     Returns:
         dict: The JSON object containing image_name, num_faces, faces, and train_set.
     """
     return {
-        'image_name': os.path.join(x[0].replace('/', '_')),
+        'image_name': x[0].replace('/', '_'),
         'num_faces': int(x[1]),
         'faces': x[2:],
-        'train_set': 1
+        'train_set': 0 if zlib.crc32(x[0].encode()) % 100 < test_percent else 1
     }
 
-# A lambda function that accesses a dictionary key and sets a new value
-def modify_value(d):
+def find_duplicate_names(files):
     """
-    Modify the input dictionary by setting the value of 'train_set' to 0.
+    Find image names that appear more than once in the annotation files.
+
+    Only the image path of each sublist is kept, so this pass is cheap enough
+    to run before anything is uploaded.
 
     Args:
-        d: A dictionary to be modified.
+        files: The paths of the FDDB ellipse annotation files.
 
     Returns:
-        The modified dictionary.
+        list: The image names that appear more than once.
+    """
+    counts = Counter(
+        sublist[0].replace('/', '_')
+        for file in files
+        for sublist in split_list_on_element(read_lines(file), split_element="/")
+        )
+    return [name for name, count in counts.items() if count > 1]
+
+def parse_entries(files):
+    """
+    Parse annotation files into JSON objects one image at a time.
+
+    Args:
+        files: The paths of the FDDB ellipse annotation files.
+
+    Yields:
+        dict: The JSON object of each image, assigned to the train or test set.
     """
-    d['train_set'] = 0
-    return d
+    for file in files:
+        for sublist in split_list_on_element(read_lines(file), split_element="/"):
+            yield map_list_to_json(sublist)
 
 def run_scenario(table_name, dyn_resource):
     """
@@ -68,7 +99,6 @@ def run_scenario(table_name, dyn_resource):
     It checks if the table exists and creates it if it doesn't. 
     It returns the DynamoDBTable object.
     """
-    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
     dt = DynamoDBTable(dyn_resource)
     table_exists = dt.exists(table_name)
 
@@ -82,58 +112,42 @@ def run_scenario(table_name, dyn_resource):
     return dt
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
 
     # Spcify data paths
     data_src = "temp_data/"
     meta_data_source = "temp_data/FDDB-folds"
 
-    files = np.sort([x for x in glob.glob(meta_data_source + "*/*") if x.find("ellipse") > 0])
-    all_lines = []
+    # Collect the ellipse annotation files from the FDDB-folds* directories
+    data_dir, folds_prefix = os.path.split(meta_data_source)
+    files = sorted(
+        entry.path
+        for folds_dir in os.scandir(data_dir)
+        if folds_dir.is_dir() and folds_dir.name.startswith(folds_prefix)
+        for entry in os.scandir(folds_dir.path)
+        if "ellipse" in entry.name
+        )
 
-    for file in files:
-        with open(file, 'r') as f:
-            lines = f.readlines()
-        lines = [x.strip() for x in lines]
-        all_lines.append(lines)
-
-    # Aggregate all lines
-    all_sublists = []
-    for lines in all_lines:
-        sublists = split_list_on_element(lines, split_element = "/")
-        all_sublists.append(sublists)
-
-    # Pipe through lambda function
-    all_jsons = []
-    for sublists in all_sublists:
-        jsons = list(map(map_list_to_json, sublists))
-        all_jsons.append(jsons)
-
-    # Flatten list of dictionaries
-    flat_json_list = [item for sublist in all_jsons for item in sublist]
-
-    # Create train and test sets
-    train, test = train_test_split(flat_json_list, test_size=0.2)
-    test = list(map(modify_value, test))
-    train.extend(test)
-    all_data = np.array(train)
-
-    # Check if duplicates in list
-    names = [x['image_name'] for x in all_data]
-    duplicates = [x for x in names if names.count(x) > 1]
+    # Check for duplicate images before anything is written
+    duplicates = find_duplicate_names(files)
     assert len(duplicates) == 0
 
-    # Set up DynamoDB
+    # Set up DynamoDB, with enough pooled connections for the writer threads
+    max_workers = 8
     dyn = boto3.resource(
         "dynamodb", region_name=AWS_REGION,
         aws_access_key_id=AWS_ACCESS_KEY,
-        aws_secret_access_key=AWS_SECRET_ACCESS_KEY
+        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+        config=Config(
+            max_pool_connections=max_workers * 2,
+            retries={"max_attempts": 10, "mode": "adaptive"},
+            ),
         )
 
     # Run scenario
     dt_name = 'facial-detection-dataset'
     dt = run_scenario(table_name=dt_name, dyn_resource=dyn)
 
-    # Upload data in batches
-    print(np.shape(all_data))
-    dt.write_batch(all_data)
+    # Parse and upload data in batches, overlapping the two
+    dt.write_stream(parse_entries(files), max_workers=max_workers)
     print(f"\nDone uploading to {dt.table.name}.")
\ No newline at end of file
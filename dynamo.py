@@ -1,71 +1,214 @@
 import boto3
 from botocore.exceptions import ClientError
-from boto3.dynamodb.conditions import Key
 import logging
+import queue
+import random
+import threading
 import time
-from credentials import AWS_ACCESS_KEY, AWS_SECRET_ACCESS_KEY, AWS_REGION
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 
 
 logger = logging.getLogger(__name__)
 MAX_GET_SIZE = 100
+MAX_WRITE_SIZE = 25
+_END_OF_ENTRIES = object()
+_CHUNK_FILL_TIMEOUT = 0.1  # Seconds a stream writer waits to fill a chunk.
 
-def do_batch_get(batch_keys):
+def do_batch_get(batch_keys, dyn_resource):
     """
     Gets a batch of items from Amazon DynamoDB. Batches can contain keys from
     more than one table.
 
     When Amazon DynamoDB cannot process all items in a batch, a set of unprocessed
-    keys is returned. This function uses an exponential backoff algorithm to retry
-    getting the unprocessed keys until all are retrieved or the specified
-    number of tries is reached.
+    keys is returned in a successful response, which the SDK does not retry. This
+    function requests the unprocessed keys again after a short, jittered,
+    exponentially increasing sleep until all are retrieved or the specified
+    number of tries is reached. Throttling errors are retried by the SDK
+    according to the retry configuration of the resource.
 
     :param batch_keys: The set of keys to retrieve. A batch can contain at most 100
                        keys. Otherwise, Amazon DynamoDB returns an error.
+    :param dyn_resource: A Boto3 DynamoDB resource.
     :return: The dictionary of retrieved items grouped under their respective
              table names.
     """
-    tries = 0
     max_tries = 5
-    sleepy_time = 1  # Start with 1 second of sleep, then exponentially increase.
+    sleepy_time = 0.1  # Start with up to 0.1 seconds of sleep, then exponentially increase.
     retrieved = {key: [] for key in batch_keys}
-    while tries < max_tries:
-        response = dynamodb.batch_get_item(RequestItems=batch_keys)
+    for tries in range(1, max_tries + 1):
+        response = dyn_resource.batch_get_item(RequestItems=batch_keys)
 
         # Collect any retrieved items and retry unprocessed keys.
         for key in response.get("Responses", []):
             retrieved[key] += response["Responses"][key]
-        unprocessed = response["UnprocessedKeys"]
-        if len(unprocessed) > 0:
-            batch_keys = unprocessed
-            unprocessed_count = sum(
-                [len(batch_key["Keys"]) for batch_key in batch_keys.values()]
-            )
-            logger.info(
-                "%s unprocessed keys returned. Sleep, then retry.", unprocessed_count
+        batch_keys = response["UnprocessedKeys"]
+        if len(batch_keys) == 0:
+            break
+        unprocessed_count = sum(
+            [len(batch_key["Keys"]) for batch_key in batch_keys.values()]
+        )
+        if tries == max_tries:
+            logger.warning(
+                "%s keys still unprocessed after %s tries. Returning partial results.",
+                unprocessed_count, max_tries
             )
-            tries += 1
-            if tries < max_tries:
-                logger.info("Sleeping for %s seconds.", sleepy_time)
-                time.sleep(sleepy_time)
-                sleepy_time = min(sleepy_time * 2, 32)
-        else:
             break
+        logger.info(
+            "%s unprocessed keys returned. Sleep, then retry.", unprocessed_count
+        )
+        time.sleep(random.uniform(0, sleepy_time))
+        sleepy_time = min(sleepy_time * 2, 2)
 
     return retrieved
 
-# Set up logger
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger()
+def _chunked(iterable, size):
+    """
+    Splits an iterable into lists of at most size items.
+
+    :param iterable: The items to split.
+    :param size: The maximum number of items per list.
+    :return: A generator of lists.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+class _TokenBucket:
+    """
+    A thread-safe token bucket used to pace writes to the provisioned write
+    capacity of a table. Tokens refill continuously at rate per second.
+    """
+
+    def __init__(self, rate):
+        """
+        :param rate: The number of tokens added per second.
+        """
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, count):
+        """
+        Consumes count tokens, possibly going into debt.
+
+        :param count: The number of tokens to consume.
+        :return: The number of seconds to wait before using the tokens.
+        """
+        with self.lock:
+            now = time.monotonic()
+            capacity = max(self.rate, count)
+            self.tokens = min(self.tokens + (now - self.last) * self.rate, capacity)
+            self.last = now
+            self.tokens -= count
+            return max(-self.tokens / self.rate, 0)
+
+    def acquire(self, count):
+        """
+        Blocks until count tokens are available, then consumes them.
+
+        :param count: The number of tokens to consume.
+        """
+        time.sleep(self.reserve(count))
+
+class _ChunkWrite:
+    """
+    Tracks the retries of one BatchWriteItem chunk. When Amazon DynamoDB cannot
+    process all items, or the table is throttled, the remaining items are
+    retried with exponential backoff until all are written or the specified
+    number of tries is reached.
+    """
+
+    max_tries = 5
+
+    def __init__(self, table_name, request_items):
+        """
+        :param table_name: The name of the table, used in error messages.
+        :param request_items: The RequestItems of the first BatchWriteItem call.
+        """
+        self.table_name = table_name
+        self.request_items = request_items
+        self.tries = 0
+        self.sleepy_time = 1  # Start with 1 second of sleep, then exponentially increase.
+
+    def processed(self, response):
+        """
+        Handles a successful BatchWriteItem response.
+
+        :param response: The BatchWriteItem response.
+        :return: None when all items are written; otherwise, the number of
+                 seconds to sleep before sending request_items again.
+        """
+        self.request_items = response["UnprocessedItems"]
+        if len(self.request_items) == 0:
+            return None
+        unprocessed_count = sum(
+            [len(requests) for requests in self.request_items.values()]
+        )
+        logger.info(
+            "%s unprocessed items returned. Sleep, then retry.", unprocessed_count
+        )
+        return self._next_delay()
+
+    def failed(self, err):
+        """
+        Handles a failed BatchWriteItem call. Errors other than throttling are
+        raised again.
+
+        :param err: The ClientError raised by the call.
+        :return: The number of seconds to sleep before sending request_items again.
+        """
+        if err.response["Error"]["Code"] != "ProvisionedThroughputExceededException":
+            raise err
+        logger.info("Throughput exceeded. Sleep, then retry.")
+        return self._next_delay()
+
+    def _next_delay(self):
+        """
+        Counts a try and returns the backoff before the next one.
+
+        :return: The number of seconds to sleep.
+        """
+        self.tries += 1
+        if self.tries >= self.max_tries:
+            raise RuntimeError(
+                f"Couldn't write all entries to table {self.table_name} "
+                f"after {self.max_tries} tries."
+            )
+        delay = self.sleepy_time
+        logger.info("Sleeping for %s seconds.", delay)
+        self.sleepy_time = min(self.sleepy_time * 2, 32)
+        return delay
 
 class DynamoDBTable:
     """Encapsulates an Amazon DynamoDB table of image data."""
 
-    def __init__(self, dyn_resource):
+    def __init__(self, dyn_resource, wcu=None):
         """
         :param dyn_resource: A Boto3 DynamoDB resource.
+        :param wcu: The write capacity units used to pace batch writes. When None,
+                    the value is read from the table description once the table
+                    is loaded or created. Zero disables pacing (on-demand tables).
         """
         self.dyn_resource = dyn_resource
+        # The resource's client marshals plain Python values to and from
+        # DynamoDB JSON, so items are never serialized by hand.
+        self._client = dyn_resource.meta.client
         self.table = None
+        self.wcu = wcu
+
+    def _load_wcu(self):
+        """
+        Reads the provisioned write capacity from the table description, unless
+        it was given to the constructor.
+        """
+        if self.wcu is None:
+            throughput = self.table.provisioned_throughput or {}
+            self.wcu = throughput.get("WriteCapacityUnits", 0)
 
     def exists(self, table_name):
         """
@@ -92,15 +235,28 @@ class DynamoDBTable:
                 raise
         else:
             self.table = table
+            self._load_wcu()
         return exists
     
-    def create_table(self, table_name):
+    def create_table(self, table_name, billing_mode="PAY_PER_REQUEST"):
         """
         Creates an Amazon DynamoDB table that can be used to store image data.
 
+        By default the table uses on-demand billing, so bulk loads with
+        write_batch are not capped by a small provisioned write capacity. With
+        billing_mode="PROVISIONED", callers doing bulk loads should raise the
+        write capacity with update_table before write_batch and lower it after.
+
         :param table_name: The name of the table to create.
+        :param billing_mode: "PAY_PER_REQUEST" or "PROVISIONED".
         :return: The newly created table.
         """
+        throughput = {}
+        if billing_mode == "PROVISIONED":
+            throughput["ProvisionedThroughput"] = {
+                "ReadCapacityUnits": 10,
+                "WriteCapacityUnits": 10,
+            }
         try:
             self.table = self.dyn_resource.create_table(
                 TableName=table_name,
@@ -112,12 +268,12 @@ class DynamoDBTable:
                     {"AttributeName": "train_set", "AttributeType": "N"},
                     {"AttributeName": "image_name", "AttributeType": "S"},
                 ],
-                ProvisionedThroughput={
-                    "ReadCapacityUnits": 10,
-                    "WriteCapacityUnits": 10,
-                },
+                BillingMode=billing_mode,
+                **throughput,
             )
             self.table.wait_until_exists()
+            self.table.reload()
+            self._load_wcu()
         except ClientError as err:
             logger.error(
                 "Couldn't create table %s. Here's why: %s: %s",
@@ -154,13 +310,14 @@ class DynamoDBTable:
         :param rating: Boolean, should be in train set.
         """
         try:
-            self.table.put_item(
+            self._client.put_item(
+                TableName=self.table.name,
                 Item={
                     "image_name": json_file["image_name"],
                     "num_faces": json_file["num_faces"],
                     "faces": json_file["faces"],
                     "train_set": json_file["train_set"],
-                }
+                },
             )
         except ClientError as err:
             logger.error(
@@ -172,37 +329,196 @@ class DynamoDBTable:
             )
             raise
 
-    def write_batch(self, entries):
+    def write_batch(self, entries, max_workers=8, chunk_size=MAX_WRITE_SIZE):
         """
-        Fills an Amazon DynamoDB table with the specified data, using the Boto3
-        Table.batch_writer() function to put the items in the table.
-        Inside the context manager, Table.batch_writer builds a list of
-        requests. On exiting the context manager, Table.batch_writer starts sending
-        batches of write requests to Amazon DynamoDB and automatically
-        handles chunking, buffering, and retrying.
+        Fills an Amazon DynamoDB table with the specified data. The entries are
+        split into chunks of at most 25 items (the BatchWriteItem limit) and the
+        chunks are written concurrently from a thread pool, each one with a
+        single low-level BatchWriteItem request.
 
-        :param movies: The data to put in the table. Each item must contain at least
-                       the keys required by the schema that was specified when the
-                       table was created.
+        Chunks are paced with a token bucket refilled at the table's write
+        capacity, so the sustained write rate stays near the provisioned WCU
+        instead of repeatedly hitting ProvisionedThroughputExceededException.
+
+        The Boto3 resource should be created with max_pool_connections of at
+        least max_workers, otherwise the threads wait on the connection pool.
+
+        :param entries: The data to put in the table. Each item must contain at least
+                        the keys required by the schema that was specified when the
+                        table was created.
+        :param max_workers: The number of threads writing chunks concurrently.
+        :param chunk_size: The number of items sent per chunk.
         """
         try:
-            with self.table.batch_writer() as writer:
-                for entry in entries:
-                    writer.put_item(Item=entry)
+            bucket = _TokenBucket(self.wcu) if self.wcu else None
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = []
+                for chunk in _chunked(entries, chunk_size):
+                    if bucket is not None:
+                        bucket.acquire(len(chunk))
+                    futures.append(executor.submit(self._write_chunk, chunk))
+                for future in futures:
+                    future.result()
 
         except ClientError as err:
-            logger.error(
-                "Couldn't load data into table %s. Here's why: %s: %s",
-                self.table.name,
-                err.response["Error"]["Code"],
-                err.response["Error"]["Message"],
-            )
+            self._log_load_error(err)
             raise
 
+    def write_stream(self, entries, max_workers=8, chunk_size=MAX_WRITE_SIZE, queue_size=1000):
+        """
+        Fills an Amazon DynamoDB table while the entries are still being
+        produced. The calling thread iterates entries, typically a generator
+        that parses the data, and puts each entry on a bounded queue. Writer
+        threads drain the queue in chunks of at most 25 items, so parsing and
+        uploading overlap and only queue_size entries are held in memory.
+
+        :param entries: An iterable of entries to put in the table. Each item must
+                        contain at least the keys required by the schema that was
+                        specified when the table was created.
+        :param max_workers: The number of writer threads.
+        :param chunk_size: The maximum number of items sent per chunk.
+        :param queue_size: The maximum number of entries waiting to be written.
+        """
+        entry_queue = queue.Queue(maxsize=queue_size)
+        bucket = _TokenBucket(self.wcu) if self.wcu else None
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = [
+                    executor.submit(self._drain_queue, entry_queue, chunk_size, bucket)
+                    for _ in range(max_workers)
+                ]
+                try:
+                    for entry in entries:
+                        self._put_entry(entry_queue, entry, futures)
+                finally:
+                    self._put_entry(entry_queue, _END_OF_ENTRIES, futures)
+                for future in futures:
+                    future.result()
+
+        except ClientError as err:
+            self._log_load_error(err)
+            raise
+
+    @staticmethod
+    def _put_entry(entry_queue, entry, futures):
+        """
+        Puts an entry on the queue. When every writer thread has stopped, the
+        queue is no longer drained, so their error is raised instead of
+        blocking forever.
+
+        :param entry_queue: The queue read by the writer threads.
+        :param entry: The entry to put on the queue.
+        :param futures: The futures of the writer threads.
+        """
+        while True:
+            try:
+                entry_queue.put(entry, timeout=1)
+                return
+            except queue.Full:
+                if all(future.done() for future in futures):
+                    for future in futures:
+                        future.result()
+
+    def _drain_queue(self, entry_queue, chunk_size, bucket):
+        """
+        Writes entries from the queue in chunks until the end marker is read.
+        After the first entry of a chunk, the writer waits up to
+        _CHUNK_FILL_TIMEOUT seconds to fill the chunk, so a momentarily empty
+        queue does not turn into many small requests. The marker is put back
+        so the other writer threads stop as well.
+
+        :param entry_queue: The queue filled by write_stream.
+        :param chunk_size: The maximum number of items sent per chunk.
+        :param bucket: The token bucket pacing the writes, or None.
+        """
+        done = False
+        while not done:
+            chunk = []
+            entry = entry_queue.get()
+            deadline = time.monotonic() + _CHUNK_FILL_TIMEOUT
+            while True:
+                if entry is _END_OF_ENTRIES:
+                    entry_queue.put(entry)
+                    done = True
+                    break
+                chunk.append(entry)
+                if len(chunk) == chunk_size:
+                    break
+                try:
+                    entry = entry_queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+            if chunk:
+                if bucket is not None:
+                    bucket.acquire(len(chunk))
+                self._write_chunk(chunk)
+
+    def _log_load_error(self, err):
+        """
+        Logs a failure to load data into the table.
+
+        :param err: The ClientError raised by Amazon DynamoDB.
+        """
+        logger.error(
+            "Couldn't load data into table %s. Here's why: %s: %s",
+            self.table.name,
+            err.response["Error"]["Code"],
+            err.response["Error"]["Message"],
+        )
+
+    def _write_chunk(self, chunk):
+        """
+        Puts a single chunk of entries with the low-level BatchWriteItem call,
+        retrying unprocessed items and throttling as described in _ChunkWrite.
+
+        :param chunk: The list of entries to put in the table.
+        """
+        write = _ChunkWrite(self.table.name, self._put_requests(chunk))
+        while True:
+            try:
+                response = self._client.batch_write_item(RequestItems=write.request_items)
+            except ClientError as err:
+                delay = write.failed(err)
+            else:
+                delay = write.processed(response)
+            if delay is None:
+                return
+            time.sleep(delay)
+
+    def _put_requests(self, chunk):
+        """
+        Builds the BatchWriteItem put requests for a chunk of entries. The
+        entries are passed as plain Python values, since the resource's client
+        serializes them to DynamoDB JSON itself.
+
+        :param chunk: The list of entries to put in the table.
+        :return: The RequestItems of a BatchWriteItem call.
+        """
+        return {
+            self.table.name: [
+                {"PutRequest": {"Item": entry}}
+                for entry in chunk
+            ]
+        }
+
     def query_table(self, query_by, query, is_train):
+        """
+        Queries the table for entries with a given key value.
+
+        :param query_by: The name of the sort key attribute to match.
+        :param query: The value of the sort key to match.
+        :param is_train: Boolean, in train set (1) or not (0).
+        :return: The list of matching entries.
+        """
         try:
-            response = self.table.query(
-                KeyConditionExpression=Key("train_set").eq(is_train) & Key(query_by).eq(query)
+            response = self._client.query(
+                TableName=self.table.name,
+                KeyConditionExpression="train_set = :train_set AND #query_by = :query",
+                ExpressionAttributeNames={"#query_by": query_by},
+                ExpressionAttributeValues={
+                    ":train_set": is_train,
+                    ":query": query,
+                },
             )
         except ClientError as err:
             logger.error(
@@ -224,7 +540,10 @@ class DynamoDBTable:
         :return: The data about the requested entry.
         """
         try:
-            response = self.table.get_item(Key={"image_name": image_name, "is_train": is_train})
+            response = self._client.get_item(
+                TableName=self.table.name,
+                Key={"image_name": image_name, "train_set": is_train},
+            )
         except ClientError as err:
             logger.error(
                 "Couldn't get entry %s from table %s. Here's why: %s: %s",
@@ -4,7 +4,7 @@ import torch.nn as nn
 import torch.nn.functional as F 
 from torch.autograd import Variable
 import numpy as np
-from utils import predict_transform
+from utils import flatten_prediction, transform_predictions
 import cv2
 
 class EmptyLayer(nn.Module):
@@ -177,7 +177,8 @@ class DarkNet(nn.Module):
     def forward(self, x, CUDA):
         modules = self.blocks[1:]
         outputs = {}
-        write = 0     #This is explained a bit later
+        predictions = []
+        heads = []
         for i, module in enumerate(modules):        
             module_type = module["type"]
 
@@ -218,18 +219,15 @@ class DarkNet(nn.Module):
                 #Get the number of classes
                 num_classes = int (module["classes"])
 
-                #Transform 
+                #Flatten, the transform is applied to all scales at once
                 x = x.data
-                x = predict_transform(x, inp_dim, anchors, num_classes, CUDA)
-                if not write:              #if no collector has been intialised. 
-                    detections = x
-                    write = 1
-
-                else:       
-                    detections = torch.cat((detections, x), 1)
+                x, head = flatten_prediction(x, inp_dim, anchors, num_classes)
+                predictions.append(x)
+                heads.append(head)
 
             outputs[i] = x
 
+        detections = transform_predictions(predictions, heads, num_classes)
         return detections
 
             
\ No newline at end of file
@@ -1,15 +1,16 @@
 from model.darknet import *
+from torchvision.io import read_image, ImageReadMode
 import wget 
 import os 
 
-def get_test_input(filename):
-    img = cv2.imread(filename)
-    img = cv2.resize(img, (416, 416))         
-    img_ =  img[:,:,::-1].transpose((2,0,1))  
-    img_ = img_[np.newaxis,:,:,:]/255.0       
-    img_ = torch.from_numpy(img_).float()     
-    img_ = Variable(img_)                  
-    return img_
+@torch.jit.script
+def _preprocess(img: torch.Tensor) -> torch.Tensor:
+    img_ = (img.float() / 255.0).unsqueeze(0)
+    return F.interpolate(img_, size=[416, 416], mode='bilinear', align_corners=False)
+
+def get_test_input(filename, device="cpu"):
+    img = read_image(filename, mode=ImageReadMode.RGB)
+    return _preprocess(img.to(device))
 
 # Download file if doesn't exist
 file_path = "dog-cycle-car.png"
@@ -0,0 +1,100 @@
+import json
+
+import boto3
+from botocore.stub import Stubber
+
+from dynamo import DynamoDBTable
+
+TABLE_NAME = "facial-detection-dataset"
+ENTRY = {"image_name": "2002_07_19_img_130", "num_faces": 1,
+         "faces": ["1 2 3 4 5 1"], "train_set": 1}
+
+
+def wire_entry():
+    # A fresh dict per use, since the resource's hooks unmarshal responses in place
+    return {"image_name": {"S": "2002_07_19_img_130"}, "num_faces": {"N": "1"},
+            "faces": {"L": [{"S": "1 2 3 4 5 1"}]}, "train_set": {"N": "1"}}
+
+
+def make_table():
+    dyn = boto3.resource(
+        "dynamodb", region_name="us-east-1",
+        aws_access_key_id="testing",
+        aws_secret_access_key="testing",
+        )
+    dt = DynamoDBTable(dyn, wcu=0)
+    dt.table = dyn.Table(TABLE_NAME)
+    return dt
+
+
+def record_bodies(dt):
+    """Records the serialized JSON body of every call made by the table's client.
+    Must be called after the Stubber is activated, so it runs before the stub
+    short-circuits the call."""
+    bodies = []
+
+    def before_call(params, **kwargs):
+        bodies.append(json.loads(params["body"]))
+
+    dt._client.meta.events.register_first("before-call.*.*", before_call)
+    return bodies
+
+
+def test_write_batch_marshals_items_once():
+    dt = make_table()
+    with Stubber(dt._client) as stubber:
+        bodies = record_bodies(dt)
+        stubber.add_response(
+            "batch_write_item", {"UnprocessedItems": {}},
+            {"RequestItems": {TABLE_NAME: [{"PutRequest": {"Item": ENTRY}}]}},
+        )
+        dt.write_batch([ENTRY], max_workers=1)
+        stubber.assert_no_pending_responses()
+    assert bodies == [{"RequestItems": {TABLE_NAME: [{"PutRequest": {"Item": wire_entry()}}]}}]
+
+
+def test_add_entry_marshals_item_once():
+    dt = make_table()
+    with Stubber(dt._client) as stubber:
+        bodies = record_bodies(dt)
+        stubber.add_response(
+            "put_item", {}, {"TableName": TABLE_NAME, "Item": ENTRY},
+        )
+        dt.add_entry(ENTRY)
+        stubber.assert_no_pending_responses()
+    assert bodies == [{"TableName": TABLE_NAME, "Item": wire_entry()}]
+
+
+def test_get_entry_returns_plain_item():
+    dt = make_table()
+    key = {"image_name": "2002_07_19_img_130", "train_set": 1}
+    with Stubber(dt._client) as stubber:
+        bodies = record_bodies(dt)
+        stubber.add_response(
+            "get_item", {"Item": wire_entry()}, {"TableName": TABLE_NAME, "Key": key},
+        )
+        item = dt.get_entry("2002_07_19_img_130", 1)
+    assert bodies == [{"TableName": TABLE_NAME, "Key": {
+        "image_name": {"S": "2002_07_19_img_130"}, "train_set": {"N": "1"}}}]
+    assert item == ENTRY
+
+
+def test_query_table_returns_plain_items():
+    dt = make_table()
+    with Stubber(dt._client) as stubber:
+        bodies = record_bodies(dt)
+        stubber.add_response(
+            "query", {"Items": [wire_entry()]},
+            {
+                "TableName": TABLE_NAME,
+                "KeyConditionExpression": "train_set = :train_set AND #query_by = :query",
+                "ExpressionAttributeNames": {"#query_by": "image_name"},
+                "ExpressionAttributeValues": {
+                    ":train_set": 1, ":query": "2002_07_19_img_130",
+                },
+            },
+        )
+        items = dt.query_table("image_name", "2002_07_19_img_130", 1)
+    assert bodies[0]["ExpressionAttributeValues"] == {
+        ":train_set": {"N": "1"}, ":query": {"S": "2002_07_19_img_130"}}
+    assert items == [ENTRY]
@@ -1,26 +1,66 @@
 from __future__ import division
+import functools
 
 import torch 
 import torch.nn as nn
 import torch.nn.functional as F 
 from torch.autograd import Variable
-import numpy as np
 import cv2 
 
-def predict_transform(prediction, inp_dim, anchors, num_classes, CUDA = True):
-    """This function transform the output of the network into bounding box table
+@functools.lru_cache(maxsize=32)
+def _grid_cache(heads, device_str, dtype):
+    """Build the per-row center offsets, anchors and strides for YOLO heads.
+
+    The result only depends on the head shapes, so it is cached across calls.
 
     Args:
-        prediction (tensor): output tensor
+        heads (tuple): tuple of (grid_size, anchors, stride) per head, where
+            anchors is a tuple of (width, height) pairs
+        device_str (str): device to build the tensors on
+        dtype (torch.dtype): dtype of the tensors
+
+    Returns:
+        tuple: center offsets, anchors and strides, each of shape (1, num_rows, 2)
+    """
+    device = torch.device(device_str)
+    offsets, scaled_anchors, strides = [], [], []
+    for grid_size, anchors, stride in heads:
+        num_anchors = len(anchors)
+        num_rows = grid_size*grid_size*num_anchors
+
+        # Center offsets, built directly on the target device
+        grid = torch.arange(grid_size, device=device, dtype=dtype)
+        a,b = torch.meshgrid(grid, grid, indexing='xy')
+
+        x_offset = a.reshape(-1,1)
+        y_offset = b.reshape(-1,1)
+        offsets.append(torch.cat((x_offset, y_offset), 1).repeat(1,num_anchors).view(-1,2))
+
+        #log space transform height and the width
+        anchors = [(a[0]/stride, a[1]/stride) for a in anchors]
+        anchors = torch.tensor(anchors, device=device, dtype=dtype)
+        scaled_anchors.append(anchors.repeat(grid_size*grid_size, 1))
+
+        strides.append(torch.full((num_rows, 1), stride, device=device, dtype=dtype))
+
+    x_y_offset = torch.cat(offsets, 0).unsqueeze(0)
+    anchors = torch.cat(scaled_anchors, 0).unsqueeze(0)
+    strides = torch.cat(strides, 0).unsqueeze(0)
+    return x_y_offset, anchors, strides
+
+def flatten_prediction(prediction, inp_dim, anchors, num_classes):
+    """Reshape the output of a YOLO head into one row per anchor and grid cell
+
+    Args:
+        prediction (tensor): output tensor of shape (batch, bbox_attrs*num_anchors, grid, grid)
         inp_dim (int): input dimension
         anchors (list): list of anchors
         num_classes (int): number of classes
-        CUDA (bool, optional): _description_. Defaults to True.
 
     Returns:
-        _type_: _description_
+        tuple: tensor of shape (batch, grid*grid*num_anchors, bbox_attrs) and
+            the (grid_size, anchors, stride) description of the head
     """
-    
     batch_size = prediction.size(0)
     stride =  inp_dim // prediction.size(2)
     grid_size = inp_dim // stride
@@ -30,39 +70,58 @@ def predict_transform(prediction, inp_dim, anchors, num_classes, CUDA = True):
     prediction = prediction.view(batch_size, bbox_attrs*num_anchors, grid_size*grid_size)
     prediction = prediction.transpose(1,2).contiguous()
     prediction = prediction.view(batch_size, grid_size*grid_size*num_anchors, bbox_attrs)
+    return prediction, (grid_size, tuple(map(tuple, anchors)), stride)
 
-    # Sigmoid the  centre_X, centre_Y. and object confidencce
-    prediction[:,:,0] = torch.sigmoid(prediction[:,:,0])
-    prediction[:,:,1] = torch.sigmoid(prediction[:,:,1])
-    prediction[:,:,4] = torch.sigmoid(prediction[:,:,4])
+def transform_predictions(predictions, heads, num_classes):
+    """Transform the flattened outputs of one or more YOLO heads into a single
+    bounding box table, applying the activations to all heads at once.
 
-    # Add the center offsets
-    grid = np.arange(grid_size)
-    a,b = np.meshgrid(grid, grid)
+    The transform runs in the dtype of the predictions, so FP16/BF16 outputs of
+    the backbone stay in low precision.
 
-    x_offset = torch.FloatTensor(a).view(-1,1)
-    y_offset = torch.FloatTensor(b).view(-1,1)
+    Args:
+        predictions (list): flattened output tensors, see flatten_prediction
+        heads (list): (grid_size, anchors, stride) description of each head
+        num_classes (int): number of classes
 
-    if CUDA:
-        x_offset = x_offset.cuda()
-        y_offset = y_offset.cuda()
+    Returns:
+        tensor: bounding boxes of shape (batch, num_rows, 5 + num_classes)
+    """
+    prediction = torch.cat(predictions, 1)
+    x_y_offset, anchors, strides = _grid_cache(tuple(heads), str(prediction.device),
+                                               prediction.dtype)
 
-    x_y_offset = torch.cat((x_offset, y_offset), 1).repeat(1,num_anchors).view(-1,2).unsqueeze(0)
-    prediction[:,:,:2] += x_y_offset
+    # Sigmoid the centre_X, centre_Y, object confidence and class scores, and
+    # build the output out-of-place instead of writing into slices of prediction
+    xy = torch.sigmoid(prediction[:,:,:2]) + x_y_offset
+    if prediction.dtype == torch.float16:
+        # Compute the box size in FP32 and clamp it to the FP16 range, since
+        # exp followed by the anchor and stride scaling overflows FP16
+        wh = torch.exp(prediction[:,:,2:4].float())*anchors.float()*strides.float()
+        wh = wh.clamp(max=torch.finfo(torch.float16).max).to(prediction.dtype)
+    else:
+        wh = torch.exp(prediction[:,:,2:4])*anchors*strides
+    obj = torch.sigmoid(prediction[:,:,4:5])
+    cls = torch.sigmoid(prediction[:,:,5: 5 + num_classes])
 
-    #log space transform height and the width
-    anchors = [(a[0]/stride, a[1]/stride) for a in anchors]
-    anchors = torch.FloatTensor(anchors)
+    # Resize bounding box to image dimensinos
+    return torch.cat((xy*strides, wh, obj, cls), 2)
 
-    if CUDA:
-        anchors = anchors.cuda()
-    anchors = anchors.repeat(grid_size*grid_size, 1).unsqueeze(0)
-    prediction[:,:,2:4] = torch.exp(prediction[:,:,2:4])*anchors
-    
-    # Class score predictions
-    prediction[:,:,5: 5 + num_classes] = torch.sigmoid((prediction[:,:, 5 : 5 + num_classes]))
+def predict_transform(prediction, inp_dim, anchors, num_classes, CUDA = True):
+    """This function transform the output of the network into bounding box table
 
-    # Resize bounding box to image dimensinos
-    prediction[:,:,:4] *= stride
-    return prediction
+    The transform runs in the dtype of prediction, so FP16/BF16 outputs of the
+    backbone stay in low precision.
 
+    Args:
+        prediction (tensor): output tensor
+        inp_dim (int): input dimension
+        anchors (list): list of anchors
+        num_classes (int): number of classes
+        CUDA (bool, optional): Unused, the device is taken from prediction. Defaults to True.
+
+    Returns:
+        tensor: bounding boxes of shape (batch, grid*grid*num_anchors, 5 + num_classes)
+    """
+    prediction, head = flatten_prediction(prediction, inp_dim, anchors, num_classes)
+    return transform_predictions([prediction], [head], num_classes)